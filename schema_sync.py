@@ -13,9 +13,9 @@ commands: a DROP and a CREATE. Which cause all your data in the field will be lo
 problem, you may want to filter "drop" actions.
 """
 import re
-from enum import Enum
+from enum import Enum, IntEnum
+from functools import lru_cache
 from typing import Dict, List, Tuple, Union
-from collections import OrderedDict
 
 __author__ = "Adam Wallner"
 __credits__ = "Kirill Gerasimenko"
@@ -29,6 +29,55 @@ __all__ = ['sync']
 WHITESPACES = (' ', '\t', '\n', '\r')
 OPERATORS = (',', '+', '-', '/', '*', '&', '<', '=', '>', '%', '^')
 
+# Precompiled regular expressions, to not parse them again and again for every line
+_RE_WHITESPACES = re.compile(r'\s+')
+_RE_STRINGS = re.compile(r"""('[^']*'?|"[^"]*"?)""")
+_RE_EXPR_WHITESPACES = re.compile('[{}]+'.format(''.join(WHITESPACES)))
+_RE_COMMENTS = re.compile(r"""('[^']*'?|"[^"]*"?)|--[^\n]*|#[^\n]*|/\*.*?(?:\*/|\Z)""", re.S)
+_RE_SPLIT_TOKENS = re.compile(r"""'[^']*'?|"[^"]*"?|[(),]""")
+_RE_OPERATOR_SPACES = re.compile(r' ?([{}]) ?'.format(re.escape(''.join(OPERATORS))))
+# Default sizes
+_DEFAULT_SIZES = {
+    'int': '(11)',
+    'tinyint': '(3)',
+    'smallint': '(6)',
+    'bigint': '(20)',
+    'varchar': '(255)',
+    'datetime': '(6)',
+    'bool': '(1)',
+}
+_RE_SIZELESS_TYPES = re.compile(r"(\s)(INT|TINYINT|SMALLINT|BIGINT|VARCHAR|DATETIME|BOOL)\s*(?![(\w])", re.I)
+_RE_DEFAULT_DECIMAL_ZERO = re.compile(r"DEFAULT 0.000000", re.I)
+# Line normalization
+_RE_JSON_CHECK = re.compile(r"\s\w+ CHARACTER SET \w+ COLLATE \w+\s+([^\n]+)\s+CHECK \(json_valid\([^)]+\)\)",
+                            re.I)
+_RE_ON_DELETE_RESTRICT = re.compile(r"\sON\s*DELETE\s*RESTRICT", re.I)
+_RE_ON_UPDATE_RESTRICT = re.compile(r"\sON\s*UPDATE\s*RESTRICT", re.I)
+_RE_LINE_AUTO_INCREMENT = re.compile(r"\s+AUTO_INCREMENT=[0-9]+", re.I)
+_RE_USING_BTREE = re.compile(r"\s*USING BTREE", re.I)
+# Keys and references
+_RE_FIELD_PRIMARY_UNIQUE = re.compile(r"^(?!PRIMARY\s|UNIQUE\s|KEY\s)\s*(`?\w+`?).*?(PRIMARY|UNIQUE)(?: KEY)?", re.I)
+_RE_UNIQUE_WITHOUT_KEY = re.compile(r"^(UNIQUE)\s*\(((`?\w+`?).*?)\)", re.I)
+_RE_PRIMARY_UNIQUE = re.compile(r'\s*(?:PRIMARY KEY|UNIQUE)(?: KEY)?', re.I)
+_RE_FIELD_REFERENCES = re.compile(r"^(?!CONSTRAINT\s|FOREIGN\s*KEY\s)\s*`?(\w+)`?.*?(REFERENCES.*)", re.I)
+_RE_REFERENCES = re.compile(r'\s*(?:REFERENCES).*$', re.I)
+_RE_FOREIGN_KEY = re.compile(r"^FOREIGN\s*KEY\s*\(`?(\w+)`?.*?REFERENCES.*", re.I)
+_RE_KEY = re.compile(r"^(PRIMARY\s+KEY)|(((UNIQUE\s+)|(FULLTEXT\s+))?KEY\s+`?\w+`?)", re.I)
+_RE_CONSTRAINT = re.compile(r"^CONSTRAINT\s+(`?\w+`?)", re.I)
+_RE_FIELD = re.compile(r"^`?\w+`?")
+_RE_CONSTRAINT_TO_KEY = re.compile(r'^CONSTRAINT\s+(`?\w+`?)\s+FOREIGN KEY\s+(\([^)]+\)).*$', re.I)
+# Table level
+_RE_TABLE_DEF = re.compile(r"(CREATE(?:\s*TEMPORARY)?\s*TABLE\s*(?:IF NOT EXISTS\s*)?\s*)(?:`?(\w+)`?\.)?"
+                           r"(?:`?(\w+)`?(?:\W|$))", re.I)
+_TABLE_AUTO_INCREMENT = r"\s*AUTO_INCREMENT=[0-9]+"
+_IF_NOT_EXISTS = r'IF NOT EXISTS\s*'
+_FORCE_IF_NOT_EXISTS = r'(CREATE(?:\s*TEMPORARY)?\s*TABLE\s*)(?:IF\sNOT\sEXISTS\s*)?(`?\w+`?)'
+# Actions
+_KEY_FIELD = r"`?\w`?(?:\(\d+\))?"  # matches `name`(10)
+_KEY_FIELD_LIST = r"(?:{}(?:,\s?)?)+".format(_KEY_FIELD)  # matches `name`(10),`desc`(255)
+_RE_KEY_FIELDS = re.compile(r"^((?:PRIMARY )|(?:UNIQUE )|(?:FULLTEXT ))?KEY `?(\w+)?`?\s*(\({}\))"
+                            .format(_KEY_FIELD_LIST), re.I)
+
 
 class _DataClass:
     def __repr__(self) -> str:
@@ -58,6 +107,15 @@ class ActionTypes(Enum):
     modify = 'MODIFY'  # MODIFY field action
 
 
+class PartTypes(IntEnum):
+    """ The types of table schema parts, in the order they are synchronized """
+    other = 0  # Not recognized part
+    constraint = 1  # Foreign keys are synchronized before everything else
+    field = 2  # Fields are synchronized before the keys
+    key = 3  # PRIMARY, UNIQUE, FULLTEXT or normal key
+
+
+@lru_cache(maxsize=4096)
 def normalize_str(string: str) -> str:
     """
     Remove multiple spaces and make lowercase
@@ -65,57 +123,90 @@ def normalize_str(string: str) -> str:
     :return: The normalized string
     """
     string = string.lower()
-    string = re.sub(r'\s+', ' ', string)
+    string = _RE_WHITESPACES.sub(' ', string)
     return string
 
 
+@lru_cache(maxsize=4096)
 def normalize_expr(expression: str) -> str:
     """
     Normalze the given SQL expression to be able to compare
     :param expression: The expression to normalize
     :return: The normalized expression
     """
-    res = ''
+    # Odd parts are the strings, which are kept untouched
+    parts = _RE_STRINGS.split(expression)
+    for i in range(0, len(parts), 2):
+        # Ensure one space, then remove unnecessary spaces around operators
+        part = _RE_EXPR_WHITESPACES.sub(' ', parts[i].lower())
+        parts[i] = _RE_OPERATOR_SPACES.sub(r'\1', part)
 
-    in_string = False
+    return ''.join(parts).strip()
 
-    o = 0
-    lc = None
-    try:
-        while True:
-            c = expression[o]
-            if not in_string:
-                if c == "'" or c == '"':   # Found string start
-                    in_string = c
-                else:
-                    # Ensure one space
-                    if c in WHITESPACES:
-                        if lc == ' ':
-                            o += 1
-                            continue
-                        c = ' '
-                    # Remove unnecessary spaces
-                    if c == ' ' and lc in OPERATORS:
-                        o += 1
-                        continue
-                    elif lc == ' ' and c in OPERATORS:
-                        res = res[:-1]
-
-                res += c.lower()
 
-            else:
-                if in_string and c == in_string:
-                    in_string = False
+def _add_default_size(m) -> str:
+    """
+    Substitution of types without size, to add their default size
+    :param m: The match object of _RE_SIZELESS_TYPES
+    :return: The type with its default size
+    """
+    type_name = m.group(2)
+    size = _DEFAULT_SIZES[type_name.lower()]
+    # Bool is tinyint in MySQL
+    if type_name.lower() == 'bool':
+        return ' TINYINT' + size + ' '
+    return m.group(1) + type_name + size + ' '
 
-                res += c
 
-            lc = c
-            o += 1
+@lru_cache(maxsize=None)
+def _get_table_fixup_re(ignore_increment: bool, ignore_if_not_exists: bool, force_if_not_exists: bool):
+    """
+    Compile the regular expression to fix table schemas, to be created, in one pass
+    :param ignore_increment: If we need to match auto increment values
+    :param ignore_if_not_exists: If we need to match IF NOT EXISTS
+    :param force_if_not_exists: If we need to match the table definition, to add IF NOT EXISTS
+    :return: The compiled regular expression or None if nothing to fix
+    """
+    alternatives = []
+    if ignore_increment:
+        alternatives.append(_TABLE_AUTO_INCREMENT)
+    # The table definition must be before IF NOT EXISTS, to match the whole definition
+    if force_if_not_exists:
+        alternatives.append(_FORCE_IF_NOT_EXISTS)
+    if ignore_if_not_exists:
+        alternatives.append(_IF_NOT_EXISTS)
+    return re.compile('|'.join(alternatives), re.I) if alternatives else None
+
+
+def _fix_table(m) -> str:
+    """
+    Substitution of _get_table_fixup_re matches
+    :param m: The match object
+    :return: The table definition with IF NOT EXISTS, or nothing for the other matches
+    """
+    if m.lastindex:  # Table definition
+        return m.group(1) + 'IF NOT EXISTS ' + m.group(2)
+    return ''
 
-    except IndexError:  # It is expected: shows no more data
-        pass
 
-    return res.strip()
+@lru_cache(maxsize=None)
+def _get_delimiter_re(delim: str, skip_in_brackets: bool):
+    """
+    Compile the regular expression to find delimiters
+    :param delim: The delimiter we search for
+    :param skip_in_brackets: If we need to match brackets as well
+    :return: The compiled regular expression, the delimiter is its 1st group
+    """
+    brackets = '()' if skip_in_brackets else ''
+    # A partially matched delimiter is skipped together with the character breaking it, which is not checked again
+    partial = ''
+    if len(delim) > 1:
+        prefix = ''
+        for c in reversed(delim[1:-1]):
+            prefix = '(?:' + re.escape(c) + prefix + ')?'
+        partial = '|' + re.escape(delim[0]) + prefix + r"""[^'"{}]?""".format(re.escape(brackets))
+    return re.compile('(' + re.escape(delim) + ')' + partial + r"""|'[^']*'?|"[^"]*"?""" +
+                      (r'|[()]' if skip_in_brackets else ''))
 
 
 def get_delimiter_pos(sql: str, *, offset: int = 0, delim: str = ';', skip_in_brackets=False) -> int:
@@ -128,38 +219,19 @@ def get_delimiter_pos(sql: str, *, offset: int = 0, delim: str = ';', skip_in_br
     :param skip_in_brackets: If we don't want to check delimiter inside brackets
     :return: The offset of the next delimiter (;)
     """
-    in_string = False
     in_brackets = 0
-    delim_chars = len(delim)
-    delim_chars_found = 0
 
-    try:
-        while True:
-            c = sql[offset]
-            if not in_string:
-                if c == delim[delim_chars_found] and not in_brackets:  # Found the delimter!
-                    delim_chars_found += 1
-                    if delim_chars == delim_chars_found:
-                        return offset - delim_chars_found + 1
-                else:
-                    delim_chars_found = 0
+    for m in _get_delimiter_re(delim, skip_in_brackets).finditer(sql, offset):
+        if m.group(1) is not None and not in_brackets:  # Found the delimter!
+            return m.start()
 
-                if c == '"' or c == "'":  # Found string start
-                    in_string = c
+        c = m.group()
+        if c == '(':
+            in_brackets += 1
+        elif c == ')':
+            in_brackets -= 1
 
-                elif skip_in_brackets:
-                    if c == '(':
-                        in_brackets += 1
-                    elif c == ')':
-                        in_brackets -= 1
-
-            elif in_string and c == in_string:
-                in_string = False
-
-            offset += 1
-
-    except IndexError:
-        raise ValueError("Invalid SQL syntax, cannot find delimiter ('{delim}')!".format(delim=delim))
+    raise ValueError("Invalid SQL syntax, cannot find delimiter ('{delim}')!".format(delim=delim))
 
 
 def filter_comments(sql: str) -> str:
@@ -168,46 +240,8 @@ def filter_comments(sql: str) -> str:
     :param sql: The SQL needs to be filtered
     :return: Same SQL without comments
     """
-    in_1l_comment = False
-    in_ml_comment = False
-    in_string = False
-    o = 0
-    res = ''
-    try:
-        while True:
-            c = sql[o]
-            if not in_1l_comment and not in_ml_comment and not in_string:
-                if c == '-' and sql[o + 1] == '-':  # Standard SQL comment
-                    in_1l_comment = True
-                    o += 1
-                elif c == '#':  # MySQL comment
-                    in_1l_comment = True
-                elif c == '/' and sql[o + 1] == '*':  # Multiline comment
-                    in_ml_comment = True
-                    o += 1
-                elif c == '"' or c == "'":  # Found string start
-                    in_string = c
-
-            elif in_string and c == in_string:
-                in_string = False
-
-            elif in_1l_comment and c == '\n':
-                in_1l_comment = False
-
-            elif in_ml_comment and c == '*' and sql[o + 1] == '/':
-                in_ml_comment = False
-                o += 2
-                continue
-
-            if not in_1l_comment and not in_ml_comment:
-                res += c
-
-            o += 1
-
-    except IndexError:  # It is expected: shows no more data
-        pass
-
-    return res
+    # Strings are matched as well (and substituted back), to not find comments inside them
+    return _RE_COMMENTS.sub(lambda m: m.group(1) or '', sql)
 
 
 def get_table_names(sql: str) -> List[str]:
@@ -215,8 +249,32 @@ def get_table_names(sql: str) -> List[str]:
     :param sql: The schema SQL
     :return: List of table names
     """
-    m = re.findall(r"CREATE(?:\s*TEMPORARY)?\s*TABLE\s*(?:IF NOT EXISTS\s*)?(?:`?(?:\w+)`?\.)?`?(\w+)`?", sql, re.I)
-    return m
+    return [m.groups()[2] for m in _RE_TABLE_DEF.finditer(sql)]
+
+
+def _get_table_sql(m, sql: str, remove_database_name_from_sql: bool) -> str:
+    """
+    Get the SQL of a table from the match of its definition
+    :param m: The match object of a table definition regex
+    :param sql: The schema SQL the table definition is matched in
+    :param remove_database_name_from_sql: If true, we filter out database names
+    :return: The table schema
+    """
+    table_def = m.group()
+    start = m.span(0)[0]
+    offset = m.span(0)[1]
+    database = m.groups()[1]
+    try:
+        end = get_delimiter_pos(sql, offset=offset)
+    except ValueError:
+        # Only the last table definition may be left without a delimiter, not to swallow the next ones
+        if _RE_TABLE_DEF.search(sql, offset):
+            raise
+        end = len(sql)
+    result = sql[start:end]
+    if database and remove_database_name_from_sql:
+        result = result.replace(table_def, m.groups()[0] + '`' + m.groups()[2] + '` ')
+    return result.strip()
 
 
 def extract_table_sql(name: str, sql: str, *, remove_database_name_from_sql: bool = True) -> str:
@@ -228,21 +286,99 @@ def extract_table_sql(name: str, sql: str, *, remove_database_name_from_sql: boo
     :return: The extracted table schema
     """
     result = None
-    for m in re.compile(r"(CREATE(?:\s*TEMPORARY)?\s*TABLE\s*(?:IF NOT EXISTS\s*)?\s*)(?:`?(\w+)`?\.)?"
-                        r"(?:`?({name})`?(?:\W|$))".format(name=name), re.I).finditer(sql):
-        table_def = m.group()
-        start = m.span(0)[0]
-        offset = m.span(0)[1]
-        database = m.groups()[1]
-        end = get_delimiter_pos(sql, offset=offset)
-        result = sql[start:end]
-        if database and remove_database_name_from_sql:
-            result = result.replace(table_def, m.groups()[0] + '`' + m.groups()[2] + '` ')
-        result = result.strip()
+    name = name.lower()
+    for m in _RE_TABLE_DEF.finditer(sql):
+        if m.groups()[2].lower() == name:
+            result = _get_table_sql(m, sql, remove_database_name_from_sql)
 
     return result
 
 
+def _index_tables(sql: str, *, remove_database_name_from_sql: bool = True) -> Dict[str, str]:
+    """
+    Extract SQL for all tables in one pass
+    :param sql: The schema SQL from we need to extract tables
+    :param remove_database_name_from_sql: If true, we filter out database names
+    :return: The extracted table schemas by table names
+    """
+    return {m.groups()[2]: _get_table_sql(m, sql, remove_database_name_from_sql) for m in _RE_TABLE_DEF.finditer(sql)}
+
+
+@lru_cache(maxsize=8192)
+def _process_line(table_name: str, line: str, ignore_increment: bool) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """
+    Process line, make some default
+    :param table_name: The name of the table
+    :param line: One line (field or key) of the table schema
+    :param ignore_increment: If true, auto increment values are filtered
+    :return: The processed lines and the lines need to be added to the bottom of the table schema
+    """
+    bottom = []
+
+    # Simplify JSON lines
+    if "CHECK" in line:
+        line = _RE_JSON_CHECK.sub(r" JSON \1", line)
+
+    # Remove DEFAULT NULL, which is the default, to be easier to compare
+    try:
+        p = get_delimiter_pos(line, delim=' DEFAULT NULL', skip_in_brackets=True)
+        line = line[:p] + line[p + 13:]  # 13 = len(' DEFAULT NULL')
+    except ValueError:
+        pass
+
+    # Remove ON DELETE RESTRICT, which is the default
+    line = _RE_ON_DELETE_RESTRICT.sub("", line)
+    # Remove ON UPDATE RESTRICT, which is the default
+    line = _RE_ON_UPDATE_RESTRICT.sub("", line)
+
+    if ignore_increment:
+        line = _RE_LINE_AUTO_INCREMENT.sub('', line)
+
+    # TODO: implement support USING keyword
+    line = _RE_USING_BTREE.sub('', line)
+
+    # PRIMARY and UNIQUE
+    m = _RE_FIELD_PRIMARY_UNIQUE.match(line)
+    m2 = _RE_UNIQUE_WITHOUT_KEY.match(line)  # UNIQUE line without key
+    if m or m2:
+        if m:
+            t = m.groups()[1]
+            k = (m.groups()[0] + ' ') if m.groups()[1].upper() == 'UNIQUE' else ''
+            f = m.groups()[0]
+            line = _RE_PRIMARY_UNIQUE.sub('', line)
+            bottom.append("{type} KEY {key}({fields})".format(type=t, key=k, fields=f))
+        else:
+            t = m2.groups()[0]
+            k = m2.groups()[2].strip()
+            f = m2.groups()[1]
+            line = "{type} KEY {key} ({fields})".format(type=t, key=k, fields=f)
+
+    else:
+        # REFERENCES
+        m = _RE_FIELD_REFERENCES.match(line)
+        if m:
+            line = _RE_REFERENCES.sub('', line)
+            bottom.append("KEY `fk_{table_name}_{key}` (`{field}`)".format(table_name=table_name,
+                                                                           key=m.groups()[0], field=m.groups()[0]))
+            bottom.append("CONSTRAINT `fk_{table_name}_{key}` ".format(table_name=table_name,
+                                                                       key=m.groups()[0]) +
+                          "FOREIGN KEY (`{field}`) ".format(field=m.groups()[0]) +
+                          "{references}".format(references=m.groups()[1]))
+        else:
+            # FOREIGN KEY without CONSTRAINT
+            m = _RE_FOREIGN_KEY.match(line)
+            if m:
+                return (
+                    "KEY `fk_{table_name}_{key}` (`{field}`)".format(table_name=table_name,
+                                                                     key=m.groups()[0],
+                                                                     field=m.groups()[0]),
+                    "CONSTRAINT `fk_{table_name}_{key}` ".format(table_name=table_name,
+                                                                 key=m.groups()[0]) + line
+                ), ()
+
+    return (line,), tuple(bottom)
+
+
 def split_table_schema(table_name: str, sql: str, *, ignore_increment: bool = True) -> List[str]:
     """
     Splits table schema SQL into a list
@@ -254,106 +390,47 @@ def split_table_schema(table_name: str, sql: str, *, ignore_increment: bool = Tr
     res = []
     bottom = []
 
-    def process_line(line):
-        """ Process line, make some default """
-        nonlocal bottom
-
-        # Add default sizes if not specified to make them comparable
-        line = re.sub(r"(\sINT)\s*(?![(\w])", r"\1(11) ", line, flags=re.I)
-        line = re.sub(r"(\sTINYINT)\s*(?![(\w])", r"\1(3) ", line, flags=re.I)
-        line = re.sub(r"(\sSMALLINT)\s*(?![(\w])", r"\1(6) ", line, flags=re.I)
-        line = re.sub(r"(\sBIGINT)\s*(?![(\w])", r"\1(20) ", line, flags=re.I)
-        line = re.sub(r"(\sVARCHAR)\s*(?![(\w])", r"\1(255) ", line, flags=re.I)
-        line = re.sub(r"(\sDATETIME)\s*(?![(\w])", r"\1(6) ", line, flags=re.I)
-        # Bool is tinyint in MySQL
-        line = re.sub(r"\sBOOL\s*(?![(\w])", r" TINYINT(1) ", line, flags=re.I)
-        # Default 0 for decimals
-        line = re.sub(r"DEFAULT 0.000000", r"DEFAULT 0", line, flags=re.I)
-
-        # Simplify JSON lines
-        if "CHECK" in line:
-            line = re.sub(r"\s\w+ CHARACTER SET \w+ COLLATE \w+\s+([^\n]+)\s+CHECK \(json_valid\([^)]+\)\)",
-                          r" JSON \1", line, flags=re.I)
-
-        # Remove DEFAULT NULL, which is the default, to be easier to compare
-        try:
-            # noinspection PyShadowingNames
-            p = get_delimiter_pos(line, delim=' DEFAULT NULL', skip_in_brackets=True)
-            line = line[:p] + line[p + 13:]  # 13 = len(' DEFAULT NULL')
-        except ValueError:
-            pass
-
-        # Remove ON DELETE RESTRICT, which is the default
-        line = re.sub(r"\sON\s*DELETE\s*RESTRICT", "", line, flags=re.I)
-        # Remove ON UPDATE RESTRICT, which is the default
-        line = re.sub(r"\sON\s*UPDATE\s*RESTRICT", "", line, flags=re.I)
-
-        if ignore_increment:
-            line = re.sub(r"\s+AUTO_INCREMENT=[0-9]+", '', line, flags=re.I)
-
-        # TODO: implement support USING keyword
-        line = re.sub(r"\s*USING BTREE", '', line, flags=re.I)
-
-        # PRIMARY and UNIQUE
-        m = re.match(r"^(?!PRIMARY\s|UNIQUE\s|KEY\s)\s*(`?\w+`?).*?(PRIMARY|UNIQUE)(?: KEY)?", line, flags=re.I)
-        m2 = re.match(r"^(UNIQUE)\s*\(((`?\w+`?).*?)\)", line, flags=re.I)  # UNIQUE line without key
-        if m or m2:
-            if m:
-                t = m.groups()[1]
-                k = (m.groups()[0] + ' ') if m.groups()[1].upper() == 'UNIQUE' else ''
-                f = m.groups()[0]
-                line = re.sub(r'\s*(?:PRIMARY KEY|UNIQUE)(?: KEY)?', '', line, flags=re.I)
-                bottom.append("{type} KEY {key}({fields})".format(type=t, key=k, fields=f))
-            else:
-                t = m2.groups()[0]
-                k = m2.groups()[2].strip()
-                f = m2.groups()[1]
-                line = "{type} KEY {key} ({fields})".format(type=t, key=k, fields=f)
-
-        else:
-            # REFERENCES
-            m = re.match(r"^(?!CONSTRAINT\s|FOREIGN\s*KEY\s)\s*`?(\w+)`?.*?(REFERENCES.*)", line, flags=re.I)
-            if m:
-                line = re.sub(r'\s*(?:REFERENCES).*$', '', line, flags=re.I)
-                bottom.append("KEY `fk_{table_name}_{key}` (`{field}`)".format(table_name=table_name,
-                                                                               key=m.groups()[0], field=m.groups()[0]))
-                bottom.append("CONSTRAINT `fk_{table_name}_{key}` ".format(table_name=table_name,
-                                                                           key=m.groups()[0]) +
-                              "FOREIGN KEY (`{field}`) ".format(field=m.groups()[0]) +
-                              "{references}".format(references=m.groups()[1]))
-            else:
-                # FOREIGN KEY without CONSTRAINT
-                m = re.match(r"^FOREIGN\s*KEY\s*\(`?(\w+)`?.*?REFERENCES.*", line, flags=re.I)
-                if m:
-                    return [
-                        "KEY `fk_{table_name}_{key}` (`{field}`)".format(table_name=table_name,
-                                                                         key=m.groups()[0],
-                                                                         field=m.groups()[0]),
-                        "CONSTRAINT `fk_{table_name}_{key}` ".format(table_name=table_name,
-                                                                     key=m.groups()[0]) + line
-                    ]
-
-        return [line]
-
     # Find opening bracket
     open_bracket_pos = get_delimiter_pos(sql, offset=0, delim='(')
     prefix = sql[:open_bracket_pos + 1]
     res.append(prefix)
     # The body (without prefix)
     body = sql[open_bracket_pos + 1:]
-    # Split by commas
+    # Split by commas, till the closing bracket
+    lines = []
     p = 0
-    try:
-        while True:
-            np = get_delimiter_pos(body, offset=p, delim=',', skip_in_brackets=True)
-            res.extend(process_line(body[p:np].strip()))
+    in_brackets = 0
+    close_bracket_pos = None
+    for m in _RE_SPLIT_TOKENS.finditer(body):
+        c = m.group()
+        if c == '(':
+            in_brackets += 1
+        elif c == ')':
+            if not in_brackets:
+                close_bracket_pos = m.start()
+                break
+            in_brackets -= 1
+        elif c == ',' and not in_brackets:
+            np = m.start()
+            lines.append(body[p:np].strip())
             p = np + 1
-    # ValueError is expected, when we have no more parts
-    except ValueError:
-        pass
+
+    if close_bracket_pos is None:
+        raise ValueError("Invalid SQL syntax, cannot find delimiter (')')!")
     # We have a last part till the closing bracket
-    close_bracket_pos = get_delimiter_pos(body, offset=p, delim=')', skip_in_brackets=True)
-    res.extend(process_line(body[p:close_bracket_pos].strip()))
+    lines.append(body[p:close_bracket_pos].strip())
+
+    # Process all the lines at once, separated by NUL chars, which are not matched by these regexes
+    fields = '\0'.join(lines)
+    # Add default sizes if not specified to make them comparable
+    fields = _RE_SIZELESS_TYPES.sub(_add_default_size, fields)
+    # Default 0 for decimals
+    fields = _RE_DEFAULT_DECIMAL_ZERO.sub(r"DEFAULT 0", fields)
+
+    for line in fields.split('\0'):
+        line_parts, bottom_parts = _process_line(table_name, line, ignore_increment)
+        res.extend(line_parts)
+        bottom.extend(bottom_parts)
 
     # Add bottom
     res += bottom
@@ -363,35 +440,38 @@ def split_table_schema(table_name: str, sql: str, *, ignore_increment: bool = Tr
     if suffix:
         res.append(suffix)
 
-    _res = "\n".join(res)
     return res
 
 
-def extract_and_normalize_keys(line: str) -> Tuple[str, str]:
+def extract_and_normalize_keys(line: str) -> Tuple[Tuple[PartTypes, str], str]:
     """
     Extract and normalize keys from a table schema "line"
     :param line: One line of table schema
-    :return: A tuble containing the key and the line
+    :return: A tuble containing the key (the type of the part and its normalized name) and the line
     """
+    t = PartTypes.other
     k = ''
     # Key definition
-    m = re.match(r"^(PRIMARY\s+KEY)|(((UNIQUE\s+)|(FULLTEXT\s+))?KEY\s+`?\w+`?)", line, flags=re.I)
+    m = _RE_KEY.match(line)
     if m:
+        t = PartTypes.key
         k = m.group()
 
     else:
         # Foreign keys
-        m = re.match(r"^(CONSTRAINT\s+`?\w+`?)", line, flags=re.I)
+        m = _RE_CONSTRAINT.match(line)
         if m:
-            k = '!!' + m.group()  # '!!' is to make sure foreign keys will be synchronized before everything else
+            t = PartTypes.constraint
+            k = m.groups()[0]
 
         else:
             # Value definition
-            m = re.match(r"^`?\w+`?", line)
+            m = _RE_FIELD.match(line)
             if m:
-                k = '!' + m.group()  # '!' is to make sure fields will be synchronised before the keys
+                t = PartTypes.field
+                k = m.group()
 
-    return normalize_str(k), line
+    return (t, normalize_str(k)), line
 
 
 def compare_table_sql(table_name: str, src_sql: str, dst_sql: str, *, ignore_increment: bool = True) -> List[DiffInfo]:
@@ -408,40 +488,34 @@ def compare_table_sql(table_name: str, src_sql: str, dst_sql: str, *, ignore_inc
     src_parts = split_table_schema(table_name, src_sql, ignore_increment=ignore_increment)
     dst_parts = split_table_schema(table_name, dst_sql, ignore_increment=ignore_increment)
 
-    src_parts_dict = OrderedDict(
-        [extract_and_normalize_keys(part) for part in src_parts[1:-1]])
-    dst_parts_dict = OrderedDict(
-        [extract_and_normalize_keys(part) for part in dst_parts[1:-1]])
+    src_parts_dict = dict(extract_and_normalize_keys(part) for part in src_parts[1:-1])
+    dst_parts_dict = dict(extract_and_normalize_keys(part) for part in dst_parts[1:-1])
 
     # Ensure we have indexes for foreign key constraints in destination table parts
-    indexes_dict = {k: p for k, p in dst_parts_dict.items() if k.startswith('key')}
-    for k, p in dict(dst_parts_dict).items():
-        if k.startswith('!!'):
-            k = k.replace('!!constraint', 'key')
-            if k not in indexes_dict:
-                dst_parts_dict[k] = re.sub(r'^CONSTRAINT\s+(`?\w+`?)\s+FOREIGN KEY\s+(\([^)]+\)).*$', r'KEY \1 \2', p,
-                                           flags=re.I)
-
-    src_keys = list(src_parts_dict.keys())
-    dst_keys = list(dst_parts_dict.keys())
+    for (t, k), p in list(dst_parts_dict.items()):
+        if t == PartTypes.constraint:
+            key = (PartTypes.key, 'key ' + k)
+            if key not in dst_parts_dict:
+                dst_parts_dict[key] = _RE_CONSTRAINT_TO_KEY.sub(r'KEY \1 \2', p)
 
-    # Fields first, then indexes - because fields are prefixed with '!'
-    all_keys = sorted(set(src_keys + dst_keys))
+    # Foreign keys first, then fields, then indexes - because of the order of part types
+    all_keys = sorted(src_parts_dict.keys() | dst_parts_dict.keys())
 
     for key in all_keys:
         info = DiffInfo()
-        in_src = key in src_keys
-        in_dst = key in dst_keys
-        src_orphan = in_src and not in_dst
-        dst_orphan = in_dst and not in_src
-        different = in_src and in_dst and normalize_expr(src_parts_dict[key]) != normalize_expr(dst_parts_dict[key])
+        src = src_parts_dict.get(key)
+        dst = dst_parts_dict.get(key)
+        src_orphan = src is not None and dst is None
+        dst_orphan = dst is not None and src is None
+        # Same lines need no normalization
+        different = src is not None and dst is not None and src != dst and normalize_expr(src) != normalize_expr(dst)
         if src_orphan:
-            info.src = src_parts_dict[key]
+            info.src = src
         elif dst_orphan:
-            info.dst = dst_parts_dict[key]
+            info.dst = dst
         elif different:
-            info.src = src_parts_dict[key]
-            info.dst = dst_parts_dict[key]
+            info.src = src
+            info.dst = dst
         else:
             continue
 
@@ -461,29 +535,24 @@ def sanitize_sql(table_name: str, sql: str) -> str:
     return parts[0] + "\n    " + ",\n    ".join(parts[1:-1]) + "\n" + parts[-1]
 
 
-def compare_tables(src: str, dst: str, *,
-                   remove_database_name_from_sql: bool = True,
+def compare_tables(src_tables: Dict[str, str], dst_tables: Dict[str, str], *,
                    ignore_increment: bool = True,
                    ignore_if_not_exists: bool = False,
                    force_if_not_exists: bool = False,
                    ) -> Dict[str, TableInfo]:
     """
     Compare the given DB structures
-    :param src: The SQL contains the source table schema definitions
-    :param dst: The SQL contains the destination table schema definitons
-    :param remove_database_name_from_sql: If True, we filter out database names
+    :param src_tables: The source table schema definitions by table names
+    :param dst_tables: The destination table schema definitons by table names
     :param ignore_increment: If true, auto increment values are filtered
     :param ignore_if_not_exists: Ignore all IF NOT EXISTS in src query
     :param force_if_not_exists: Force all commands to have IF NOT EXISTS
     :return: The differences by all the tables source and destination SQLs contain
     """
-    src_table_names = get_table_names(src)
-    dst_table_names = get_table_names(dst)
-
-    common = [v for v in src_table_names if v in dst_table_names]
-    src_orphans = [v for v in src_table_names if v not in common]
-    dst_orphans = [v for v in dst_table_names if v not in common]
-    all_tables = OrderedDict.fromkeys(src_table_names + dst_table_names)
+    src_orphans = src_tables.keys() - dst_tables.keys()
+    dst_orphans = dst_tables.keys() - src_tables.keys()
+    all_tables = dict.fromkeys(list(src_tables) + list(dst_tables))
+    fixup_re = _get_table_fixup_re(ignore_increment, ignore_if_not_exists, force_if_not_exists)
 
     res = {}
 
@@ -494,21 +563,16 @@ def compare_tables(src: str, dst: str, *,
             info.src_orphan = True
         # Is it only in destination
         elif table_name in dst_orphans:
-            dst_sql = extract_table_sql(table_name, dst, remove_database_name_from_sql=remove_database_name_from_sql)
+            dst_sql = dst_tables[table_name]
             # TODO: These may remove text from field and table comments, though very unlikely to put SQL there
-            if ignore_increment:
-                dst_sql = re.sub(r"\s*AUTO_INCREMENT=[0-9]+", '', dst_sql, flags=re.I)
-            if ignore_if_not_exists:
-                dst_sql = re.sub(r'IF NOT EXISTS\s*', '', dst_sql, flags=re.I)
-            if force_if_not_exists:
-                dst_sql = re.sub(r'(CREATE(?:\s*TEMPORARY)?\s*TABLE\s*)(?:IF\sNOT\sEXISTS\s*)?(`?\w+`?)',
-                                 r'\1IF NOT EXISTS \2', dst_sql, flags=re.I)
+            if fixup_re:
+                dst_sql = fixup_re.sub(_fix_table, dst_sql)
 
             info.dst_orphan = sanitize_sql(table_name, dst_sql)
 
         else:
-            src_sql = extract_table_sql(table_name, src, remove_database_name_from_sql=remove_database_name_from_sql)
-            dst_sql = extract_table_sql(table_name, dst, remove_database_name_from_sql=remove_database_name_from_sql)
+            src_sql = src_tables[table_name]
+            dst_sql = dst_tables[table_name]
             diffs = compare_table_sql(table_name, src_sql, dst_sql, ignore_increment=ignore_increment)
 
             if diffs:
@@ -557,41 +621,35 @@ def get_action_sql(table, sql, action) -> Tuple[str, int]:
     :param action: The needed action
     :return: The update SQL according to the action
     """
-    res = "ALTER TABLE `{table}` ".format(table=table)
+    res = f"ALTER TABLE `{table}` "
     insert_direction = 0
 
-    re_key_field = r"`?\w`?(?:\(\d+\))?"  # matches `name`(10)
-    re_key_field_list = r"(?:{}(?:,\s?)?)+".format(re_key_field)  # matches `name`(10),`desc`(255)
-    re_fields = r"^((?:PRIMARY )|(?:UNIQUE )|(?:FULLTEXT ))?KEY `?(\w+)?`?\s*(\({}\))".format(re_key_field_list)
-    m = re.match(re_fields, sql, flags=re.I)
+    m = _RE_KEY_FIELDS.match(sql)
     if m:
         key_type = (m.groups()[0] or '').strip().upper()
         key_name = (m.groups()[1] or '').strip()
         fields = m.groups()[2].strip()
 
         if action == ActionTypes.drop:
-            res += 'DROP PRIMARY KEY' if key_type == 'PRIMARY' else 'DROP INDEX `{}`'.format(key_name)
+            res += 'DROP PRIMARY KEY' if key_type == 'PRIMARY' else f'DROP INDEX `{key_name}`'
             insert_direction = -1
 
         elif action == ActionTypes.add:
             if key_type == 'PRIMARY':
-                res += 'ADD PRIMARY KEY {fields}'.format(fields=fields)
+                res += f'ADD PRIMARY KEY {fields}'
             elif not key_type:
-                res += 'ADD INDEX `{key_name}` {fields}'.format(key_name=key_name, fields=fields)
+                res += f'ADD INDEX `{key_name}` {fields}'
             else:
-                res += 'ADD {key_type} `{key_name}` {fields}'.format(
-                    key_type=key_type, key_name=key_name, fields=fields)  # //fulltext or unique
+                res += f'ADD {key_type} `{key_name}` {fields}'  # //fulltext or unique
             insert_direction = 1
 
         elif action == ActionTypes.modify:
             if key_type == 'PRIMARY':
-                res += 'DROP PRIMARY KEY, ADD PRIMARY KEY {fields}'.format(fields=fields)
+                res += f'DROP PRIMARY KEY, ADD PRIMARY KEY {fields}'
             elif not key_type:
-                res += 'DROP INDEX `{key_name}`, ADD INDEX `{key_name}` {fields}'.format(
-                    key_name=key_name, fields=fields)
+                res += f'DROP INDEX `{key_name}`, ADD INDEX `{key_name}` {fields}'
             else:
-                res += 'DROP INDEX `{key_name}`, ADD {key_type} `{key_name}` {fields}'.format(
-                    key_type=key_type, key_name=key_name, fields=fields)
+                res += f'DROP INDEX `{key_name}`, ADD {key_type} `{key_name}` {fields}'
             insert_direction = -1
 
     # Foreign key
@@ -642,7 +700,7 @@ def get_diff_sql(compare_info: Dict[str, TableInfo]) -> List[str]:
         if info.src_orphan:
             # Drop table from source
             # noinspection SqlResolve
-            sqls.append("DROP TABLE `{table}`".format(table=table))
+            sqls.append(f"DROP TABLE `{table}`")
         elif info.dst_orphan:
             # Create table in source
             sqls.append(info.dst_orphan)
@@ -696,10 +754,9 @@ def sync(src: str, dst: str, *, as_str: bool = True,
     :return: List of queries or an SQL string containing commands to transform src into dest
     """
     res = []
-    src = filter_comments(src)
-    dst = filter_comments(dst)
-    compare_info = compare_tables(src, dst,
-                                  remove_database_name_from_sql=remove_database_name_from_sql,
+    src_tables = _index_tables(filter_comments(src), remove_database_name_from_sql=remove_database_name_from_sql)
+    dst_tables = _index_tables(filter_comments(dst), remove_database_name_from_sql=remove_database_name_from_sql)
+    compare_info = compare_tables(src_tables, dst_tables,
                                   ignore_increment=ignore_increment,
                                   ignore_if_not_exists=ignore_if_not_exists,
                                   force_if_not_exists=force_if_not_exists)
@@ -788,8 +845,32 @@ CREATE TABLE `metadata` (
     print(res)
 
 
+def _test3():
+    # The last statement may miss its delimiter
+    sql1 = """CREATE TABLE `a` (`id` INT);
+CREATE TABLE `b` (`id` INT)"""
+    sql2 = """CREATE TABLE `a` (`id` INT);"""
+
+    res = sync(sql1, sql2)
+    print(res)
+    assert res == "DROP TABLE `b`;"
+    assert sync(sql2, sql1) == "CREATE TABLE IF NOT EXISTS `b` (\n    `id` INT(11) \n);"
+
+    # But an unterminated statement must not swallow the next table definitions
+    sql1 = """CREATE TABLE `a` (`id` INT)
+CREATE TABLE `b` (`id` INT)"""
+    try:
+        sync(sql1, sql2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Missing delimiter is not detected")
+
+
 if __name__ == '__main__':
     print("* Test1")
     _test1()
     print("\n* Test2")
     _test2()
+    print("\n* Test3")
+    _test3()